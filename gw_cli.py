@@ -16,9 +16,18 @@ import logging
 import re
 import textwrap
 import signal
+import sys
 import time
+import random
+import select
+import socket
+import contextlib
+import io
+import shutil
 import configparser
-from ipaddress import IPv4Network
+import hashlib
+import json
+from ipaddress import IPv4Address, IPv4Network
 
 
 logging.basicConfig(
@@ -31,6 +40,31 @@ logger = logging.getLogger(__name__)
 IP_REX = 'inet [0-9]+.[0-9]+.[0-9]+.[0-9]+/[0-9]+'
 file_path_systemd_config = '/etc/systemd/network/10-eth0.network'
 file_path_unmanaged = '/etc/NetworkManager/conf.d/unmanaged.conf'
+file_path_modem_config = '/config/ModemConfig'
+file_path_supervisor_metrics = '/tmp/gw_supervisor.json'
+modem_device = '/dev/ttyUSB0'
+dir_path_profiles = '/config/profiles'
+ACTIVE_PROFILE = 'active'
+dir_path_systemd_units = '/etc/systemd/system'
+# Units reading the linked network config must wait for the profiles mount
+PROFILE_MOUNT_UNITS = ('systemd-networkd.service', 'NetworkManager.service')
+# Long running or nested commands can't be part of a batch
+BATCH_EXCLUDED_COMMANDS = ('apply', 'supervise', 'benchmark_profiles')
+# Commands reading or switching the network config, or whose effect a later
+# NetworkManager restart could undo, see pending writes applied first
+BATCH_BARRIER_COMMANDS = ('create_profile', 'activate_profile',
+                          'deactivate_profile', 'set_mtu', 'setup_modem',
+                          'load_from_yaml')
+# Commands mixing immediate and deferred steps run outside the batch so
+# their steps keep the order of a separate call
+BATCH_DIRECT_COMMANDS = ('load_from_yaml',)
+SNAPSHOT_SUFFIX = '.snap'
+# Bump whenever CONFIG_SCHEMA or the parse_modem_config output changes so
+# snapshots written by older versions are validated again
+SNAPSHOT_VERSION = 1
+
+# Prefer the libyaml based loader, fall back to the pure python one
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 
 class EmptyArgsException(Exception):
@@ -89,6 +123,85 @@ def run_subprocess(args=[]):
     return result
 
 
+class Batch:
+    """Collects config writes and reloads of several operations.
+
+    While a batch is active change_hostvalues, change_ipv4 and
+    restart_network_manager only record their changes, flush() then
+    writes the network config once and restarts NetworkManager once.
+    """
+
+    def __init__(self):
+        self.hostvalues = {}
+        self.addresses = {}
+        self.restart = False
+        # Index of the running operation and of those with pending changes
+        self.operation = None
+        self.pending = []
+
+    def defer(self):
+        if self.operation is not None and self.operation not in self.pending:
+            self.pending.append(self.operation)
+
+    def flush(self):
+        # Returns the first failed subprocess result, like the change_*
+        # helpers do
+        try:
+            result = None
+            with batch_suspended():
+                if self.hostvalues:
+                    write_hostvalues(self.hostvalues)
+                if self.addresses:
+                    result = update_nmcli_addresses(self.addresses)
+                elif self.restart:
+                    result = restart_network_manager()
+            return first_failure(result)
+        finally:
+            self.hostvalues = {}
+            self.addresses = {}
+            self.restart = False
+            self.pending = []
+
+
+active_batch = None
+
+
+@contextlib.contextmanager
+def batched():
+    global active_batch
+    batch = active_batch = Batch()
+    try:
+        yield batch
+    finally:
+        active_batch = None
+
+
+@contextlib.contextmanager
+def batch_suspended():
+    global active_batch
+    previous, active_batch = active_batch, None
+    try:
+        yield
+    finally:
+        active_batch = previous
+
+
+def restart_network_manager():
+    if active_batch is not None:
+        active_batch.restart = True
+        active_batch.defer()
+        return None
+    args = ['systemctl', 'restart', 'NetworkManager']
+    return run_subprocess(args=args)
+
+
+def first_failure(*results):
+    for result in results:
+        if isinstance(result, Exception):
+            return result
+    return None
+
+
 def make_dhcp_server_config(begin_ip_range, end_ip_range, lease_time,
                             domain_name):
     return textwrap.dedent(f"""\
@@ -161,8 +274,7 @@ def swap_dhcp_state(flag=True):
     change_hostvalues(dhcp_dict, 'Network')
 
     #stop_dhcp_server_if_running()   
-    args = ['systemctl', 'restart', 'NetworkManager']
-    run_subprocess(args=args)
+    return restart_network_manager()
 
 
 
@@ -184,8 +296,7 @@ def change_dhcp_server(domain_name, begin_ip_range, end_ip_range, lease_time):
     change_hostvalues(dhcp_dict, 'DHCPServer')
 
     #stop_dhcp_server_if_running()   
-    args = ['systemctl', 'restart', 'NetworkManager']
-    run_subprocess(args=args)
+    return restart_network_manager()
 
 
 def change_ipv4(address, netmask, device='eth0'):
@@ -211,22 +322,31 @@ def change_ipv4(address, netmask, device='eth0'):
 
     change_hostvalues(ipv4_dict, 'Network')
 
+    if active_batch is not None:
+        active_batch.addresses['eth0'] = new_address
+        active_batch.defer()
+        return
+
+    return update_nmcli_addresses({'eth0': new_address})
+
+
+def update_nmcli_addresses(addresses):
     change_unmanaged_state(True)
 
-    args = ['systemctl', 'restart', 'NetworkManager']
-    run_subprocess(args=args)
+    results = [restart_network_manager()]
 
-    args = ['nmcli', 'con', 'mod', 'eth0', 'ipv4.address', new_address]
-    run_subprocess(args=args)
+    for con_name, address in addresses.items():
+        args = ['nmcli', 'con', 'mod', con_name, 'ipv4.address', address]
+        results.append(run_subprocess(args=args))
 
     change_unmanaged_state(False)
 
-    args = ['systemctl', 'restart', 'NetworkManager']
-    run_subprocess(args=args)
+    results.append(restart_network_manager())
+    return first_failure(*results)
 
    
 def config_handler(operator_apn='internet', pin=None, autoreconnect=False, user = None, password= None):
-    path = '/config/ModemConfig'
+    path = file_path_modem_config
     if not os.path.isfile(path):
         config = configparser.ConfigParser()
         config.optionxform = str
@@ -237,9 +357,6 @@ def config_handler(operator_apn='internet', pin=None, autoreconnect=False, user
             'Password': 'password',
             'Autoreconnect': autoreconnect
         }
-        configfile = open(path, 'w')
-        config.write(configfile, space_around_delimiters=False)
-        configfile.close()
     else:
         config = configparser.ConfigParser()
         config.optionxform = str
@@ -252,53 +369,553 @@ def config_handler(operator_apn='internet', pin=None, autoreconnect=False, user
             config.set('Modem', 'Password', 'password')
         
         config.set('Modem', 'Autoreconnect', str(autoreconnect))
-        configfile = open(path, 'w')
-        config.write(configfile, space_around_delimiters=False)
-        configfile.close()
-
-def autostart():
-    time.sleep(30)
-    path = '/config/ModemConfig'
-    os.path.exists('/dev/ttyUSB0')
-    for x in range(3):
-        if os.path.exists('/dev/ttyUSB0'):
-            if os.path.isfile(path):
-                config = configparser.ConfigParser()
-                config.optionxform = str
-                config.read(path)
-                if config.getboolean('Modem','Autoreconnect'):
-                    set_modem(operator_apn=config['Modem']['Apn'], pin=config['Modem']['Pin'], user=config['Modem']['User'], password=config['Modem']['Password'])
-                    break
-        else:
-            time.sleep(3)
+    buffer = io.StringIO()
+    config.write(buffer, space_around_delimiters=False)
+    data = buffer.getvalue().encode()
+    with open(path, 'wb') as configfile:
+        configfile.write(data)
+    try:
+        write_snapshot(path, data, parse_modem_config(data))
+    except Exception as e:
+        logger.error(f'Error while writing modem config snapshot: {e}')
+
+def sd_notify(*messages):
+    # Minimal sd_notify(3) implementation, no libsystemd required
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall('\n'.join(messages).encode())
+        return True
+    except Exception as e:
+        logger.error(f'Error while notifying systemd: {e}')
+        return False
 
 
-def process_yaml(yml):
+def watchdog_interval():
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    # Ping twice per watchdog period as recommended by sd_watchdog_enabled(3)
+    return int(usec) / 2 / 1000000
+
+
+def autoreconnect_enabled(path=file_path_modem_config):
+    return os.path.isfile(path) and load_modem_config(path)['autoreconnect']
+
+
+def modem_available(device=modem_device):
+    if not os.path.exists(device):
+        return False
+    result = run_subprocess(args=['mmcli', '-m', 'any'])
+    return not isinstance(result, Exception)
+
+
+def autostart(timeout=60):
+    # READY marks the end of the boot bring-up attempt, not connectivity:
+    # without coverage the supervisor keeps retrying and the connection
+    # state is reported through STATUS
+    if not autoreconnect_enabled():
+        sd_notify('READY=1', 'STATUS=Autoreconnect disabled')
+        return False
+    connected = connect_at_boot(timeout)
+    if connected:
+        sd_notify('READY=1', 'STATUS=Connected')
+    else:
+        sd_notify('READY=1', 'STATUS=Not connected, retrying')
+    return connected
+
+
+def connect_at_boot(timeout):
+    modem_config = load_modem_config()
+    sd_notify('STATUS=Waiting for modem')
+    deadline = time.monotonic() + timeout
+    while not modem_available():
+        if time.monotonic() > deadline:
+            logger.error(f'No modem found within {timeout}s')
+            return False
+        time.sleep(1)
+    sd_notify('STATUS=Connecting')
+    result = connect_modem(
+        operator_apn=modem_config['operator_apn'],
+        pin=modem_config['pin']
+    )
+    return not isinstance(result, Exception)
+
+
+def read_source(path):
+    with open(path, 'rb') as source_file:
+        return source_file.read()
+
+
+def load_yaml_source(yml):
+    # Returns the raw bytes together with the parsed config so snapshots
+    # are keyed by exactly the content that was parsed
     logger.info(f'Processing YAML file {yml}')
     if not os.path.isfile(yml):
         logger.error(f'{yml} does not exist')
         raise InvalidArgumentException
+    data = read_source(yml)
     try:
-        with open(yml, 'r') as yml_file:
-            config = yaml.safe_load(yml_file)
+        config = yaml.load(data, Loader=YAML_LOADER)
         logger.info('Successfully processed YAML file')
-        return config
+        return data, config
     except Exception as e:
         logger.error(f'Error while reading YAML file got: {e}')
+        return data, None
+
+
+def process_yaml(yml):
+    return load_yaml_source(yml)[1]
+
+
+def check_ipv4(value):
+    IPv4Address(value)
+
+
+def check_netmask(value):
+    IPv4Network(f'0.0.0.0/{value}')
+
+
+def check_mtu(value):
+    if not value.isdigit() or not 68 <= int(value) <= 65535:
+        raise ValueError(f'{value} is not a valid MTU')
+
+
+# Field options: required, default, aliases (accepted alternative keys),
+# type (accepted YAML types of the raw value) and check (callable raising on
+# invalid values). All values are normalized to strings or None since they
+# end up as subprocess or config file arguments.
+CONFIG_SCHEMA = {
+    'localNetwork': {
+        'hostname': {'required': True, 'type': str},
+        'ipAddress': {'required': True, 'type': str, 'check': check_ipv4},
+        'subnetMask': {'required': True, 'type': (str, int),
+                       'check': check_netmask},
+        'mtu': {'required': True, 'type': int, 'check': check_mtu},
+        'device': {'default': 'eth0', 'type': str},
+    },
+    'dhcpServer': {
+        'domainName': {'required': True, 'type': str},
+        'beginIpRange': {'required': True, 'type': str, 'check': check_ipv4},
+        'endIpRange': {'required': True, 'type': str, 'check': check_ipv4},
+        'leaseTime': {'required': True, 'type': (str, int)},
+    },
+    'modem': {
+        'conName': {'default': 'mobile', 'type': str},
+        'operatorApn': {'default': 'internet', 'type': str},
+        'pin': {'type': str},
+        'user': {'aliases': ['username'], 'type': str},
+        'password': {'type': str},
+    },
+}
+
+
+def none_if_empty(value):
+    if value is None or str(value) in ('', 'None'):
         return None
+    return str(value)
+
+
+def check_type(value, types):
+    # YAML 1.1 turns e.g. a PIN 0123 into the octal int 83, so the raw
+    # type has to be checked before the value is converted to a string
+    types = types if isinstance(types, tuple) else (types,)
+    if isinstance(value, bool) and bool not in types:
+        return False
+    return isinstance(value, types)
+
+
+def validate_config(config, schema=CONFIG_SCHEMA):
+    logger.info('Validating config')
+    if not isinstance(config, dict):
+        raise InvalidArgumentException('Config has to be a mapping')
+    normalized = {}
+    for section, fields in schema.items():
+        values = config.get(section)
+        if not isinstance(values, dict):
+            raise InvalidArgumentException(f'Missing section {section}')
+        known = set()
+        normalized[section] = {}
+        for key, options in fields.items():
+            names = [key] + options.get('aliases', [])
+            known.update(names)
+            raw = None
+            for name in names:
+                raw = values.get(name)
+                if none_if_empty(raw) is not None:
+                    break
+            value = none_if_empty(raw)
+            if value is not None and 'type' in options\
+                    and not check_type(raw, options['type']):
+                raise InvalidArgumentException(
+                    f'Invalid type {type(raw).__name__} for {section}.{key}')
+            if value is None:
+                value = options.get('default')
+            if value is None:
+                if options.get('required'):
+                    raise InvalidArgumentException(
+                        f'Missing value for {section}.{key}')
+            elif 'check' in options:
+                try:
+                    options['check'](value)
+                except ValueError as e:
+                    raise InvalidArgumentException(
+                        f'Invalid value for {section}.{key}: {e}')
+            normalized[section][key] = value
+        unknown = set(values) - known
+        if unknown:
+            raise InvalidArgumentException(
+                f'Unknown keys in {section}: {", ".join(sorted(unknown))}')
+    return normalized
+
+
+def snapshot_path(source):
+    return source + SNAPSHOT_SUFFIX
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def write_snapshot(source, data, config, output=None):
+    output = output or snapshot_path(source)
+    logger.info(f'Writing snapshot of {source} to {output}')
+    write_json(output, {
+        'version': SNAPSHOT_VERSION,
+        'hash': content_hash(data),
+        'config': config
+    })
+    return output
+
+
+def read_snapshot(source, data=None, snapshot=None):
+    snapshot = snapshot or snapshot_path(source)
+    try:
+        if data is None:
+            data = read_source(source)
+        with open(snapshot, 'r') as snapshot_file:
+            content = json.load(snapshot_file)
+        if content.get('version') != SNAPSHOT_VERSION\
+                or content.get('hash') != content_hash(data):
+            logger.info(f'Snapshot {snapshot} is outdated')
+            return None
+        logger.info(f'Using snapshot {snapshot}')
+        return content['config']
+    except Exception as e:
+        logger.info(f'No usable snapshot {snapshot}: {e}')
+        return None
+
+
+def compile_yaml_config(yml, output=None):
+    data, config = load_yaml_source(yml)
+    if not config:
+        raise InvalidArgumentException(f'Could not read {yml}')
+    config = validate_config(config)
+    write_snapshot(yml, data, config, output=output)
+    return config
+
+
+def load_config(yml, snapshot=None):
+    config = read_snapshot(yml, snapshot=snapshot)
+    if config is not None:
+        return config
+    config = process_yaml(yml)
+    if not config:
+        return None
+    return validate_config(config)
+
+
+def parse_modem_config(data):
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read_string(data.decode())
+    return {
+        'operator_apn': config.get('Modem', 'Apn', fallback='internet'),
+        'pin': none_if_empty(config.get('Modem', 'Pin', fallback=None)),
+        'user': none_if_empty(config.get('Modem', 'User', fallback=None)),
+        'password': none_if_empty(
+            config.get('Modem', 'Password', fallback=None)),
+        'autoreconnect': config.getboolean(
+            'Modem', 'Autoreconnect', fallback=False)
+    }
+
+
+def load_modem_config(path=file_path_modem_config):
+    data = read_source(path)
+    modem_config = read_snapshot(path, data=data)
+    if modem_config is not None:
+        return modem_config
+    modem_config = parse_modem_config(data)
+    try:
+        write_snapshot(path, data, modem_config)
+    except Exception as e:
+        logger.error(f'Error while writing modem config snapshot: {e}')
+    return modem_config
+
+
+def connection_exists(con_name='mobile'):
+    args = ['nmcli', '-g', 'connection.id', 'connection', 'show', con_name]
+    result = run_subprocess(args=args)
+    return not isinstance(result, Exception)
+
+
+def is_connection_active(con_name='mobile'):
+    args = ['nmcli', '-g', 'GENERAL.STATE', 'connection', 'show', con_name]
+    result = run_subprocess(args=args)
+    if isinstance(result, Exception):
+        return False
+    return result.stdout.decode().strip() == 'activated'
+
+
+def bring_up_modem(con_name='mobile'):
+    if not os.path.isfile(file_path_modem_config):
+        logger.error(f'{file_path_modem_config} does not exist')
+        return False
+    modem_config = load_modem_config(file_path_modem_config)
+    result = connect_modem(
+        con_name=con_name,
+        operator_apn=modem_config['operator_apn'],
+        pin=modem_config['pin']
+    )
+    return not isinstance(result, Exception)
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    # Exponential backoff with equal jitter so a fleet of gateways losing
+    # the same cell does not retry in lockstep
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class ConnectionSupervisor:
+    """Keeps the cellular connection up and records outage metrics.
+
+    Link and modem state changes are taken from the event streams of
+    nmcli and mmcli. Failed bring-ups are retried with jittered
+    exponential backoff; after failure_threshold consecutive failures the
+    circuit opens and attempts pause for cooldown seconds.
+    """
+
+    MONITOR_COMMANDS = [
+        ['nmcli', 'monitor'],
+        ['mmcli', '-m', 'any', '--monitor-state']
+    ]
+
+    def __init__(self, con_name='mobile', base_delay=5, max_delay=300,
+                 failure_threshold=5, cooldown=600,
+                 metrics_path=file_path_supervisor_metrics, bring_up=None,
+                 clock=time.monotonic):
+        self.con_name = con_name
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.metrics_path = metrics_path
+        self.bring_up = bring_up or (lambda: bring_up_modem(con_name))
+        self.clock = clock
+        self.watchdog_interval = watchdog_interval()
+        self.monitors = [None] * len(self.MONITOR_COMMANDS)
+        self.monitor_failures = [0] * len(self.MONITOR_COMMANDS)
+        self.monitor_restart_at = [None] * len(self.MONITOR_COMMANDS)
+        self.connected = None
+        self.outage_start = None
+        self.failures = 0
+        self.next_attempt = None
+        self.metrics = {
+            'connected': None,
+            'circuit_open': False,
+            'outages': 0,
+            'reconnects': 0,
+            'reconnect_attempts': 0,
+            'failed_attempts': 0,
+            'circuit_trips': 0,
+            'last_outage_duration': None,
+            'max_outage_duration': 0,
+            'total_outage_duration': 0
+        }
+
+    def write_metrics(self):
+        self.metrics['connected'] = self.connected
+        self.metrics['updated_at'] = time.time()
+        if not self.metrics_path:
+            return
+        try:
+            write_json(self.metrics_path, self.metrics)
+        except Exception as e:
+            logger.error(f'Error while writing supervisor metrics: {e}')
+
+    def on_state(self, connected):
+        now = self.clock()
+        if connected:
+            if self.outage_start is not None:
+                duration = now - self.outage_start
+                logger.info(f'{self.con_name} recovered after {duration:.1f}s')
+                self.metrics['last_outage_duration'] = duration
+                self.metrics['max_outage_duration'] = max(
+                    self.metrics['max_outage_duration'], duration)
+                self.metrics['total_outage_duration'] += duration
+                self.outage_start = None
+            self.failures = 0
+            self.next_attempt = None
+            self.metrics['circuit_open'] = False
+            sd_notify(f'STATUS={self.con_name} connected')
+        elif self.outage_start is None:
+            logger.info(f'{self.con_name} is down')
+            sd_notify(f'STATUS={self.con_name} down, reconnecting')
+            self.outage_start = now
+            self.next_attempt = now
+            self.metrics['outages'] += 1
+        self.connected = connected
+        self.write_metrics()
+
+    def retry_timeout(self):
+        if self.next_attempt is None:
+            return None
+        return max(0, self.next_attempt - self.clock())
+
+    def monitor_restart_timeout(self):
+        restart_at = [at for at in self.monitor_restart_at if at is not None]
+        if not restart_at:
+            return None
+        return max(0, min(restart_at) - self.clock())
+
+    def wait_timeout(self):
+        timeouts = [timeout for timeout in
+                    (self.retry_timeout(), self.watchdog_interval,
+                     self.monitor_restart_timeout())
+                    if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def attempt_reconnect(self):
+        if self.next_attempt is None or self.clock() < self.next_attempt:
+            return
+        logger.info(f'Reconnecting {self.con_name}')
+        self.metrics['reconnect_attempts'] += 1
+        if self.bring_up():
+            self.metrics['reconnects'] += 1
+            self.on_state(True)
+            return
+        self.failures += 1
+        self.metrics['failed_attempts'] += 1
+        if self.failures >= self.failure_threshold:
+            logger.error(
+                f'{self.failures} failed attempts, pausing for '
+                f'{self.cooldown}s')
+            self.metrics['circuit_open'] = True
+            self.metrics['circuit_trips'] += 1
+            delay = self.cooldown
+        else:
+            delay = backoff_delay(
+                self.failures - 1, self.base_delay, self.max_delay)
+        self.next_attempt = self.clock() + delay
+        self.write_metrics()
+
+    def start_monitor(self, index):
+        args = self.MONITOR_COMMANDS[index]
+        logger.info(f'Starting monitor {args}')
+        self.monitor_restart_at[index] = None
+        try:
+            self.monitors[index] = subprocess.Popen(
+                args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except Exception as e:
+            logger.error(f'Could not start monitor {args}: {e}')
+            self.schedule_monitor_restart(index)
+
+    def schedule_monitor_restart(self, index):
+        # mmcli exits right away while no modem is present, so restarts
+        # back off instead of spawning a new process every few seconds
+        self.monitors[index] = None
+        delay = backoff_delay(
+            self.monitor_failures[index], self.base_delay, self.max_delay)
+        self.monitor_failures[index] += 1
+        self.monitor_restart_at[index] = self.clock() + delay
+
+    def restart_monitors(self):
+        now = self.clock()
+        for index, restart_at in enumerate(self.monitor_restart_at):
+            if restart_at is not None and now >= restart_at:
+                self.start_monitor(index)
+
+    def stop_monitors(self):
+        for index, monitor in enumerate(self.monitors):
+            if monitor is not None:
+                monitor.terminate()
+                monitor.wait()
+                self.monitors[index] = None
+
+    def run(self):
+        for index in range(len(self.MONITOR_COMMANDS)):
+            self.start_monitor(index)
+        if not any(self.monitors):
+            raise InvalidArgumentException('No event monitor could be started')
+        try:
+            self.on_state(is_connection_active(self.con_name))
+            while True:
+                if self.watchdog_interval:
+                    sd_notify('WATCHDOG=1')
+                self.restart_monitors()
+                self.attempt_reconnect()
+                streams = {monitor.stdout: index
+                           for index, monitor in enumerate(self.monitors)
+                           if monitor is not None}
+                timeout = self.wait_timeout()
+                if not streams and timeout is None:
+                    timeout = self.base_delay
+                readable, _, _ = select.select(
+                    list(streams), [], [], timeout)
+                if not readable:
+                    continue
+                for stream in readable:
+                    index = streams[stream]
+                    line = stream.readline()
+                    if not line:
+                        # Only this monitor exited (e.g. modem removed)
+                        logger.error(
+                            f'Monitor {self.MONITOR_COMMANDS[index]} exited')
+                        self.monitors[index].wait()
+                        self.schedule_monitor_restart(index)
+                        continue
+                    self.monitor_failures[index] = 0
+                    logger.debug(f'Event: {line.decode().strip()}')
+                self.on_state(is_connection_active(self.con_name))
+        finally:
+            self.stop_monitors()
 
 
 def set_modem(con_name='mobile', operator_apn='internet', pin=None, user=None,
               password=None):
     logger.info('Setting up modem')
-    
+    config_handler(operator_apn=operator_apn, pin=pin, autoreconnect=True, user = None, password= None)
+    return connect_modem(
+        con_name=con_name, operator_apn=operator_apn, pin=pin)
+
+
+def connect_modem(con_name='mobile', operator_apn='internet', pin=None):
+    # Bring-up without touching /config/ModemConfig, used on every
+    # (re)connect attempt
+    logger.info(f'Connecting {con_name}')
     if pin:
         args_pin = ['mmcli', '-i', '0', '--pin', pin]
         run_subprocess(args=args_pin)
         time.sleep(2)
-    args = ['nmcli', 'c', 'add', 'type', 'gsm', 'ifname', '*',
-            'con-name', con_name, 'apn', operator_apn]
-    config_handler(operator_apn=operator_apn, pin=pin, autoreconnect=True, user = None, password= None)
+    if connection_exists(con_name):
+        args = ['nmcli', 'c', 'modify', con_name, 'gsm.apn', operator_apn]
+    else:
+        args = ['nmcli', 'c', 'add', 'type', 'gsm', 'ifname', '*',
+                'con-name', con_name, 'apn', operator_apn]
     setup_result = run_subprocess(args=args)
     args = ['nmcli', 'c', 'up', con_name]
     return run_subprocess(args=args)
@@ -306,14 +923,25 @@ def set_modem(con_name='mobile', operator_apn='internet', pin=None, user=None,
 
 
 def change_hostvalues(valueDict, section):
+    ensure_not_profile_link()
+    if active_batch is not None:
+        active_batch.hostvalues.setdefault(section, {}).update(valueDict)
+        active_batch.defer()
+        return
+    write_hostvalues({section: valueDict})
+
+
+def write_hostvalues(valueDicts):
+    ensure_not_profile_link()
     args = ['mount', '-o', 'remount,rw', '/']
     run_subprocess(args=args)    
 
     config = configparser.ConfigParser()
     config.optionxform = str
     config.read(file_path_systemd_config)
-    for key in valueDict:
-        config.set(section, key, valueDict[key]) 
+    for section, valueDict in valueDicts.items():
+        for key in valueDict:
+            config.set(section, key, valueDict[key]) 
 
     cfgfile = open(file_path_systemd_config,'w')
     config.write(cfgfile, space_around_delimiters=False)  
@@ -339,13 +967,212 @@ def change_unmanaged_state(flag):
     args = ['mount', '-o', 'remount,ro', '/']
     run_subprocess(args=args)
 
+
+def profile_path(name, profiles_dir=dir_path_profiles):
+    if not name\
+            or name == ACTIVE_PROFILE\
+            or name.startswith('.')\
+            or os.sep in name:
+        raise InvalidArgumentException(f'Invalid profile name {name}')
+    return os.path.join(profiles_dir, name)
+
+
+def list_profiles(profiles_dir=dir_path_profiles):
+    if not os.path.isdir(profiles_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(profiles_dir)
+        if name != ACTIVE_PROFILE
+        and os.path.isdir(os.path.join(profiles_dir, name))
+        and not os.path.islink(os.path.join(profiles_dir, name)))
+
+
+def get_active_profile(profiles_dir=dir_path_profiles):
+    active = os.path.join(profiles_dir, ACTIVE_PROFILE)
+    if not os.path.islink(active):
+        return None
+    return os.readlink(active)
+
+
+def is_profile_link(target=file_path_systemd_config,
+                    profiles_dir=dir_path_profiles):
+    source = os.path.join(
+        profiles_dir, ACTIVE_PROFILE, os.path.basename(target))
+    return os.path.islink(target) and os.readlink(target) == source
+
+
+def ensure_not_profile_link():
+    # Writing through the link would silently change the active profile
+    if is_profile_link(file_path_systemd_config, dir_path_profiles):
+        message = (f'{file_path_systemd_config} is managed by profile '
+                   f'{get_active_profile(dir_path_profiles)}, use '
+                   'create-profile and activate-profile instead or '
+                   'deactivate-profile first')
+        logger.error(message)
+        raise InvalidArgumentException(message)
+
+
+def profile_base_path(target=file_path_systemd_config,
+                      profiles_dir=dir_path_profiles):
+    return os.path.join(profiles_dir, os.path.basename(target) + '.orig')
+
+
+def save_profile_base(target=file_path_systemd_config,
+                      profiles_dir=dir_path_profiles):
+    # The original config is kept as backup and stays the base every
+    # profile is rendered from
+    base = profile_base_path(target, profiles_dir)
+    if os.path.isfile(base):
+        return base
+    if is_profile_link(target, profiles_dir) or not os.path.isfile(target):
+        logger.error(f'No base config {base} to render profiles from')
+        raise InvalidArgumentException(f'{base} does not exist')
+    logger.info(f'Saving {target} to {base}')
+    os.makedirs(profiles_dir, exist_ok=True)
+    tmp_path = base + '.tmp'
+    shutil.copy2(target, tmp_path)
+    os.replace(tmp_path, base)
+    return base
+
+
+def render_profile(name, valueDicts, target=file_path_systemd_config,
+                   profiles_dir=dir_path_profiles):
+    logger.info(f'Rendering profile {name}')
+    directory = profile_path(name, profiles_dir)
+    base = save_profile_base(target, profiles_dir)
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(base)
+    for section, valueDict in valueDicts.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for key in valueDict:
+            config.set(section, key, str(valueDict[key]))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, os.path.basename(target))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as cfgfile:
+        config.write(cfgfile, space_around_delimiters=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def replace_symlink(source, link):
+    tmp_link = link + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(source, tmp_link)
+    os.replace(tmp_link, link)
+
+
+def install_profile_mount_dependencies(profiles_dir=dir_path_profiles):
+    # Without these the link may still dangle when the network services
+    # read it at boot, if the profiles live on a separately mounted fs
+    for unit in PROFILE_MOUNT_UNITS:
+        directory = os.path.join(dir_path_systemd_units, unit + '.d')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'gw-cli-profiles.conf')
+        with open(path, 'w') as dropin:
+            dropin.write(f'[Unit]\nRequiresMountsFor={profiles_dir}\n')
+    args = ['systemctl', 'daemon-reload']
+    run_subprocess(args=args)
+
+
+def install_profile_link(target=file_path_systemd_config,
+                         profiles_dir=dir_path_profiles):
+    # One time setup: point the system config at the active profile so
+    # switching profiles never has to touch the root filesystem again
+    if is_profile_link(target, profiles_dir):
+        return
+    save_profile_base(target, profiles_dir)
+    source = os.path.join(
+        profiles_dir, ACTIVE_PROFILE, os.path.basename(target))
+    logger.info(f'Linking {target} to {source}')
+    remount = not os.access(os.path.dirname(target), os.W_OK)\
+        or not os.access(dir_path_systemd_units, os.W_OK)
+    if remount:
+        args = ['mount', '-o', 'remount,rw', '/']
+        run_subprocess(args=args)
+    install_profile_mount_dependencies(profiles_dir)
+    replace_symlink(source, target)
+    if remount:
+        args = ['mount', '-o', 'remount,ro', '/']
+        run_subprocess(args=args)
+
+
+def switch_profile(name, reload=True, target=file_path_systemd_config,
+                   profiles_dir=dir_path_profiles):
+    logger.info(f'Switching to profile {name}')
+    directory = profile_path(name, profiles_dir)
+    if not os.path.isdir(directory):
+        logger.error(f'Profile {name} does not exist')
+        raise InvalidArgumentException(f'Profile {name} does not exist')
+    if get_active_profile(profiles_dir) == name:
+        logger.info(f'Profile {name} is already active')
+        return False
+    replace_symlink(name, os.path.join(profiles_dir, ACTIVE_PROFILE))
+    install_profile_link(target, profiles_dir)
+    if reload:
+        restart_network_manager()
+    return True
+
+
+def clear_profile(reload=True, target=file_path_systemd_config,
+                  profiles_dir=dir_path_profiles):
+    # Puts the saved original back in place of the link, the .orig copy is
+    # dropped so later profiles are rendered from the edited config
+    if not is_profile_link(target, profiles_dir):
+        logger.info('No profile is active')
+        return False
+    base = profile_base_path(target, profiles_dir)
+    if not os.path.isfile(base):
+        logger.error(f'{base} does not exist')
+        raise InvalidArgumentException(f'{base} does not exist')
+    logger.info(f'Restoring {target} from {base}')
+    remount = not os.access(os.path.dirname(target), os.W_OK)
+    if remount:
+        args = ['mount', '-o', 'remount,rw', '/']
+        run_subprocess(args=args)
+    tmp_path = target + '.tmp'
+    shutil.copy2(base, tmp_path)
+    os.replace(tmp_path, target)
+    if remount:
+        args = ['mount', '-o', 'remount,ro', '/']
+        run_subprocess(args=args)
+    os.remove(os.path.join(profiles_dir, ACTIVE_PROFILE))
+    os.remove(base)
+    if reload:
+        restart_network_manager()
+    return True
+
+
+def benchmark_profile_switch(names, rounds=1, reload=True,
+                             target=file_path_systemd_config,
+                             profiles_dir=dir_path_profiles):
+    results = []
+    for _ in range(rounds):
+        for name in names:
+            previous = get_active_profile(profiles_dir)
+            start = time.perf_counter()
+            if switch_profile(name, reload=reload, target=target,
+                              profiles_dir=profiles_dir):
+                results.append(
+                    (previous, name, time.perf_counter() - start))
+    return results
+
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     autostart()
+    if autoreconnect_enabled():
+        ConnectionSupervisor().run()
 
 
 @click.group()
-def cli():
-    click.echo('### GW-CLI ###')
+@click.pass_context
+def cli(ctx):
+    # Keep the output of apply machine readable
+    if ctx.invoked_subcommand != 'apply':
+        click.echo('### GW-CLI ###')
 
 
 @cli.command()
@@ -354,20 +1181,20 @@ def cli():
     (CIRD format) and 999.999.999.999 (long mask format)')
 @click.option('--device', default='eth0', help='Device to assign the address')
 def set_ipv4(address, netmask, device):
-    change_ipv4(address, netmask, device)
+    return change_ipv4(address, netmask, device)
 
 
 @cli.command()
 @click.option('--mtu', help='MTU to assign to device')
 @click.option('--device', default='eth0', help='Device to assign the MTU to')
 def set_mtu(mtu, device):
-    change_mtu(mtu, device)
+    return change_mtu(mtu, device)
 
 
 @cli.command()
 @click.option('--hostname', help='New hostname')
 def set_hostname(hostname):
-    change_hostname(hostname)
+    return change_hostname(hostname)
 
 
 @cli.command()
@@ -376,41 +1203,242 @@ def set_hostname(hostname):
 @click.option('--end-ip-range', help='End of IP range')
 @click.option('--lease-time', help='Lease time as string')
 def set_dhcp_server(domain_name, begin_ip_range, end_ip_range, lease_time):
-    change_dhcp_server(domain_name, begin_ip_range, end_ip_range, lease_time)
+    return change_dhcp_server(domain_name, begin_ip_range, end_ip_range, lease_time)
 
 
 @cli.command()
 @click.option('--yml', default='yaml_template.yml', help='YAML file to load')
-def load_from_yaml(yml):
-    config = process_yaml(yml)
+@click.option('--snapshot', default=None,
+              help='Snapshot written by compile --output, defaults to the '
+              'YAML file with .snap suffix')
+def load_from_yaml(yml, snapshot):
+    config = load_config(yml, snapshot=snapshot)
     if not config:
         return
     local_network = config.get('localNetwork')
-    change_hostname(local_network.get('hostname'))
-    change_ipv4(
+    results = [change_hostname(local_network.get('hostname'))]
+    results.append(change_ipv4(
         local_network.get('ipAddress'),
         local_network.get('subnetMask'),
         local_network.get('device')
-    )
-    change_mtu(
+    ))
+    results.append(change_mtu(
         local_network.get('mtu'),
         local_network.get('device')
-    )
+    ))
     dhcp_server = config.get('dhcpServer')
-    change_dhcp_server(
+    results.append(change_dhcp_server(
         dhcp_server.get('domainName'),
         dhcp_server.get('beginIpRange'),
         dhcp_server.get('endIpRange'),
         dhcp_server.get('leaseTime')
-    )
+    ))
     modem_config = config.get('modem')
-    set_modem(
+    results.append(set_modem(
         con_name=modem_config.get('conName'),
         operator_apn=modem_config.get('operatorApn'),
         pin=modem_config.get('pin', None),
         user=modem_config.get('user', None),
         password=modem_config.get('password', None)
-    )
+    ))
+    return first_failure(*results)
+
+
+@cli.command('compile')
+@click.option('--yml', default='yaml_template.yml', help='YAML file to compile')
+@click.option('--output', default=None,
+              help='Snapshot file, defaults to the YAML file with .snap suffix')
+def compile_yaml(yml, output):
+    compile_yaml_config(yml, output=output)
+    click.echo(f'Compiled {yml} to {output or snapshot_path(yml)}')
+
+
+@cli.command()
+@click.option('--name', default='mobile', help='Connection name')
+@click.option('--base-delay', default=5.0, help='First retry delay in seconds')
+@click.option('--max-delay', default=300.0, help='Maximum retry delay in seconds')
+@click.option('--failure-threshold', default=5,
+              help='Failed attempts before pausing reconnects')
+@click.option('--cooldown', default=600.0,
+              help='Pause after failure-threshold failed attempts in seconds')
+@click.option('--metrics', default=file_path_supervisor_metrics,
+              help='JSON file reconnect metrics are written to')
+def supervise(name, base_delay, max_delay, failure_threshold, cooldown,
+              metrics):
+    if not autoreconnect_enabled():
+        click.echo('Autoreconnect is disabled')
+        return
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    ConnectionSupervisor(
+        con_name=name,
+        base_delay=base_delay,
+        max_delay=max_delay,
+        failure_threshold=failure_threshold,
+        cooldown=cooldown,
+        metrics_path=metrics
+    ).run()
+
+
+@cli.command()
+@click.option('--name', help='Profile name')
+@click.option('--dhcp-server/--dhcp-client', default=None,
+              help='Run a DHCP server or a DHCP client on the device')
+@click.option('--address', help='IPv4 address to assign to device')
+@click.option('--netmask', help='IPv4 netmask supported formats: 99\
+    (CIRD format) and 999.999.999.999 (long mask format)')
+@click.option('--begin-ip-range', help='Begin of IP range')
+@click.option('--end-ip-range', help='End of IP range')
+def create_profile(name, dhcp_server, address, netmask, begin_ip_range,
+                   end_ip_range):
+    valueDicts = {}
+    if dhcp_server is not None:
+        valueDicts['Network'] = {
+            'DHCP': str(not dhcp_server).lower(),
+            'DHCPServer': str(dhcp_server).lower()
+        }
+    if address:
+        if not netmask:
+            raise InvalidArgumentException
+        netmask_bits = IPv4Network(f'0.0.0.0/{netmask}').prefixlen
+        valueDicts.setdefault('Network', {})['Address'] = \
+            f'{address}/{netmask_bits}'
+    if begin_ip_range:
+        valueDicts.setdefault('DHCPServer', {})['PoolOffset'] = begin_ip_range
+    if end_ip_range:
+        valueDicts.setdefault('DHCPServer', {})['PoolSize'] = end_ip_range
+    path = render_profile(name, valueDicts, target=file_path_systemd_config,
+                          profiles_dir=dir_path_profiles)
+    click.echo(f'Rendered {path}')
+
+
+@cli.command()
+@click.option('--name', help='Profile name')
+@click.option('--reload/--no-reload', default=True,
+              help='Restart NetworkManager after switching')
+def activate_profile(name, reload):
+    switch_profile(name, reload=reload, target=file_path_systemd_config,
+                   profiles_dir=dir_path_profiles)
+
+
+@cli.command()
+@click.option('--reload/--no-reload', default=True,
+              help='Restart NetworkManager after switching')
+def deactivate_profile(reload):
+    clear_profile(reload=reload, target=file_path_systemd_config,
+                  profiles_dir=dir_path_profiles)
+
+
+@cli.command()
+@click.option('--rounds', default=3, help='Number of passes over all profiles')
+@click.option('--reload/--no-reload', default=True,
+              help='Restart NetworkManager after switching')
+def benchmark_profiles(rounds, reload):
+    names = list_profiles()
+    if len(names) < 2:
+        raise InvalidArgumentException('At least two profiles are required')
+    results = benchmark_profile_switch(names, rounds=rounds, reload=reload)
+    for previous, name, seconds in results:
+        click.echo(f'{previous} -> {name}: {seconds * 1000:.2f} ms')
+    total = sum(seconds for _, _, seconds in results)
+    click.echo(f'Average: {total / len(results) * 1000:.2f} ms')
+
+
+def get_operation_command(ctx, op):
+    if not isinstance(op, str):
+        raise InvalidArgumentException(f'Unknown operation {op}')
+    command = cli.get_command(ctx, op)\
+        or cli.get_command(ctx, op.replace('_', '-'))
+    if command is None:
+        raise InvalidArgumentException(f'Unknown operation {op}')
+    if command.name.replace('-', '_') in BATCH_EXCLUDED_COMMANDS:
+        raise InvalidArgumentException(f'Unsupported operation {op}')
+    return command
+
+
+def run_operation(ctx, operation):
+    if not isinstance(operation, dict):
+        raise InvalidArgumentException('Operation has to be an object')
+    operation = dict(operation)
+    command = get_operation_command(ctx, operation.pop('op', None))
+    with command.make_context(
+            command.name, [], parent=ctx, resilient_parsing=True) as sub_ctx:
+        params = dict(sub_ctx.params)
+        for param in command.params:
+            for key in (param.name, param.name.replace('_', '-')):
+                if key in operation:
+                    params[param.name] = param.type_cast_value(
+                        sub_ctx, operation.pop(key))
+        if operation:
+            raise InvalidArgumentException(
+                f'Unknown arguments {", ".join(sorted(operation))}')
+        name = command.name.replace('-', '_')
+        if active_batch is not None and name in BATCH_BARRIER_COMMANDS:
+            pending = list(active_batch.pending)
+            failure = active_batch.flush()
+            if failure is not None:
+                raise InvalidArgumentException(
+                    f'Applying pending changes of operations {pending} '
+                    f'failed: {failure}')
+        if name in BATCH_DIRECT_COMMANDS:
+            with batch_suspended():
+                return sub_ctx.invoke(command.callback, **params)
+        return sub_ctx.invoke(command.callback, **params)
+
+
+@cli.command()
+@click.argument('stream', type=click.File('r'), default='-')
+@click.pass_context
+def apply(ctx, stream):
+    """Run newline delimited JSON operations from STREAM (default stdin).
+
+    Each line is an object like {"op": "set_hostname", "hostname": "gw"}
+    with the options of the subcommand as keys. One JSON result is printed
+    per operation, an operation fails if one of its commands failed.
+    Operations marked pending are applied by a later flush; the final flush
+    result lists the operations it covered.
+    Config writes and NetworkManager restarts of all operations are merged
+    and done once at the end, or earlier before profile, MTU and modem
+    commands so they keep the order of separate calls.
+    """
+    failed = False
+    with batched() as batch:
+        for index, line in enumerate(stream):
+            if not line.strip():
+                continue
+            result = {'index': index}
+            batch.operation = index
+            try:
+                operation = json.loads(line)
+                if isinstance(operation, dict):
+                    result['op'] = operation.get('op')
+                # Keep stdout for the JSON results
+                with contextlib.redirect_stdout(sys.stderr):
+                    failure = first_failure(run_operation(ctx, operation))
+                if failure is not None:
+                    raise failure
+                result['ok'] = True
+                if index in batch.pending:
+                    # Only applied with the next flush
+                    result['pending'] = True
+            except Exception as e:
+                logger.error(f'Operation {index} failed: {e}')
+                result.update(ok=False, error=str(e))
+                failed = True
+            click.echo(json.dumps(result))
+    batch.operation = None
+    result = {'op': 'flush', 'operations': list(batch.pending)}
+    try:
+        failure = batch.flush()
+        if failure is not None:
+            raise failure
+        result['ok'] = True
+    except Exception as e:
+        logger.error(f'Flushing batch failed: {e}')
+        result.update(ok=False, error=str(e))
+        failed = True
+    click.echo(json.dumps(result))
+    if failed:
+        ctx.exit(1)
 
 
 @cli.command()
@@ -420,7 +1448,7 @@ def load_from_yaml(yml):
 @click.option('--user', default=None, help='Username')
 @click.option('--password', default=None, help='Password')
 def setup_modem(apn, name, pin, user, password):
-    set_modem(
+    return set_modem(
         con_name=name,
         operator_apn=apn,
         pin=pin,
@@ -8,6 +8,12 @@
 # @Description: Test cases for command line tool gw_cli.
 import unittest
 import tempfile
+import yaml
+import os
+import json
+import subprocess
+import socket
+from unittest import mock
 
 from click.testing import CliRunner
 from gw_cli import (
@@ -18,7 +24,28 @@ from gw_cli import (
     set_mtu,
     set_dhcp_server,
     process_yaml,
-    setup_modem
+    setup_modem,
+    compile_yaml,
+    validate_config,
+    load_config,
+    read_snapshot,
+    snapshot_path,
+    write_snapshot,
+    SNAPSHOT_VERSION,
+    load_modem_config,
+    bring_up_modem,
+    backoff_delay,
+    ConnectionSupervisor,
+    sd_notify,
+    watchdog_interval,
+    autostart,
+    render_profile,
+    switch_profile,
+    list_profiles,
+    get_active_profile,
+    deactivate_profile,
+    benchmark_profile_switch,
+    apply
 )
 
 
@@ -289,6 +316,495 @@ class TestGwCli(unittest.TestCase):
         ])
         self.assertNotEqual(result.exit_code, 0)
 
+    def test_validate_config_normalizes(self):
+        config = validate_config(process_yaml('yaml_template.yml'))
+        self.assertEqual(config['localNetwork']['mtu'], '2500')
+        self.assertEqual(config['modem']['conName'], 'mobile')
+        self.assertIn('user', config['modem'])
+        self.assertIsNone(config['modem']['pin'])
+
+    def test_validate_config_username_alias(self):
+        config = process_yaml('yaml_template.yml')
+        config['modem']['username'] = 'someone'
+        config = validate_config(config)
+        self.assertEqual(config['modem']['user'], 'someone')
+
+    def test_validate_config_failure_missing_value(self):
+        config = process_yaml('yaml_template.yml')
+        del config['localNetwork']['hostname']
+        self.assertRaises(InvalidArgumentException, validate_config, config)
+
+    def test_validate_config_failure_invalid_address(self):
+        config = process_yaml('yaml_template.yml')
+        config['dhcpServer']['beginIpRange'] = '192.168.0.300'
+        self.assertRaises(InvalidArgumentException, validate_config, config)
+
+    def test_validate_config_failure_wrong_type(self):
+        with open('yaml_template.yml', 'r') as original_yaml:
+            content = original_yaml.read()
+        config = yaml.safe_load(content.replace('pin: null', 'pin: 0123'))
+        self.assertEqual(config['modem']['pin'], 83)
+        self.assertRaises(InvalidArgumentException, validate_config, config)
+        config = process_yaml('yaml_template.yml')
+        config['localNetwork']['mtu'] = '1500'
+        self.assertRaises(InvalidArgumentException, validate_config, config)
+        config['localNetwork']['mtu'] = True
+        self.assertRaises(InvalidArgumentException, validate_config, config)
+
+    def test_validate_config_failure_unknown_key(self):
+        config = process_yaml('yaml_template.yml')
+        config['modem']['usr'] = 'someone'
+        self.assertRaises(InvalidArgumentException, validate_config, config)
+
+    def test_compile_success(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            yml = os.path.join(tmp_dir, 'config.yml')
+            with open('yaml_template.yml', 'r') as original_yaml:
+                content = original_yaml.read()
+            with open(yml, 'w') as temp_yaml:
+                temp_yaml.write(content)
+            result = self.runner.invoke(compile_yaml, args=['--yml', yml])
+            self.assertEqual(result.exit_code, 0)
+            snapshot = read_snapshot(yml)
+            self.assertEqual(snapshot, validate_config(process_yaml(yml)))
+            self.assertEqual(load_config(yml), snapshot)
+            with open(yml, 'a') as temp_yaml:
+                temp_yaml.write("  pin: '1234'\n")
+            self.assertIsNone(read_snapshot(yml))
+            self.assertEqual(load_config(yml)['modem']['pin'], '1234')
+            self.assertTrue(os.path.isfile(snapshot_path(yml)))
+
+    def test_snapshot_version_mismatch_ignored(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            yml = os.path.join(tmp_dir, 'config.yml')
+            with open('yaml_template.yml', 'rb') as original_yaml:
+                data = original_yaml.read()
+            with open(yml, 'wb') as temp_yaml:
+                temp_yaml.write(data)
+            config = validate_config(process_yaml(yml))
+            write_snapshot(yml, data, config)
+            self.assertEqual(read_snapshot(yml), config)
+            with mock.patch('gw_cli.SNAPSHOT_VERSION', SNAPSHOT_VERSION + 1):
+                self.assertIsNone(read_snapshot(yml))
+
+    def test_compile_custom_output(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            yml = os.path.join(tmp_dir, 'config.yml')
+            output = os.path.join(tmp_dir, 'boot.snap')
+            with open('yaml_template.yml', 'r') as original_yaml:
+                content = original_yaml.read()
+            with open(yml, 'w') as temp_yaml:
+                temp_yaml.write(content)
+            result = self.runner.invoke(compile_yaml, args=[
+                '--yml', yml, '--output', output])
+            self.assertEqual(result.exit_code, 0)
+            self.assertFalse(os.path.isfile(snapshot_path(yml)))
+            with mock.patch('gw_cli.process_yaml') as process:
+                config = load_config(yml, snapshot=output)
+            process.assert_not_called()
+            self.assertEqual(config['modem']['conName'], 'mobile')
+
+    def test_load_modem_config_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'ModemConfig')
+            with open(path, 'w') as config_file:
+                config_file.write('[Modem]\nApn=internet\nPin=None\n'
+                                  'Autoreconnect=True\n')
+            modem_config = load_modem_config(path)
+            self.assertIsNone(modem_config['pin'])
+            self.assertTrue(modem_config['autoreconnect'])
+            self.assertEqual(read_snapshot(path), modem_config)
+            with open(path, 'w') as config_file:
+                config_file.write('[Modem]\nApn=other\nPin=1234\n'
+                                  'Autoreconnect=False\n')
+            self.assertIsNone(read_snapshot(path))
+            modem_config = load_modem_config(path)
+            self.assertEqual(modem_config['operator_apn'], 'other')
+            self.assertFalse(modem_config['autoreconnect'])
+
+    def test_compile_failure_invalid_config(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            yml = os.path.join(tmp_dir, 'config.yml')
+            with open(yml, 'w') as temp_yaml:
+                temp_yaml.write('localNetwork:\n  hostname: gw\n')
+            result = self.runner.invoke(compile_yaml, args=['--yml', yml])
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIsInstance(result.exception, InvalidArgumentException)
+            self.assertFalse(os.path.isfile(snapshot_path(yml)))
+
+    def test_backoff_delay(self):
+        for attempt in range(10):
+            delay = backoff_delay(attempt, 5, 300)
+            expected = min(300, 5 * 2 ** attempt)
+            self.assertGreaterEqual(delay, expected / 2)
+            self.assertLessEqual(delay, expected)
+
+    def test_supervisor_reconnect_metrics(self):
+        now = [0]
+        results = [False, False, True]
+        supervisor = ConnectionSupervisor(
+            base_delay=1, max_delay=10, metrics_path=None,
+            bring_up=lambda: results.pop(0), clock=lambda: now[0])
+        supervisor.on_state(True)
+        now[0] = 10
+        supervisor.on_state(False)
+        self.assertEqual(supervisor.retry_timeout(), 0)
+        supervisor.attempt_reconnect()
+        self.assertGreater(supervisor.retry_timeout(), 0)
+        now[0] = 20
+        supervisor.attempt_reconnect()
+        now[0] = 30
+        supervisor.attempt_reconnect()
+        self.assertTrue(supervisor.connected)
+        self.assertIsNone(supervisor.retry_timeout())
+        self.assertEqual(supervisor.metrics['outages'], 1)
+        self.assertEqual(supervisor.metrics['reconnects'], 1)
+        self.assertEqual(supervisor.metrics['failed_attempts'], 2)
+        self.assertEqual(supervisor.metrics['last_outage_duration'], 20)
+
+    def test_supervisor_monitor_restart_backoff(self):
+        now = [0]
+        supervisor = ConnectionSupervisor(
+            base_delay=1, max_delay=10, metrics_path=None,
+            bring_up=lambda: True, clock=lambda: now[0])
+        supervisor.MONITOR_COMMANDS = [['true'], ['/nonexistent/monitor']]
+        supervisor.start_monitor(0)
+        supervisor.start_monitor(1)
+        self.assertIsNotNone(supervisor.monitors[0])
+        self.assertIsNone(supervisor.monitors[1])
+        self.assertLessEqual(supervisor.wait_timeout(), 1)
+        now[0] = 1
+        supervisor.restart_monitors()
+        self.assertEqual(supervisor.monitor_failures[1], 2)
+        self.assertGreaterEqual(supervisor.monitor_restart_timeout(), 1)
+        self.assertIsNotNone(supervisor.monitors[0])
+        supervisor.stop_monitors()
+        self.assertEqual(supervisor.monitors, [None, None])
+
+    def test_bring_up_modem_keeps_modem_config(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'ModemConfig')
+            content = ('[Modem]\nApn=internet\nPin=None\nUser=someone\n'
+                       'Password=secret\nAutoreconnect=True\n')
+            with open(path, 'w') as config_file:
+                config_file.write(content)
+            with mock.patch('gw_cli.file_path_modem_config', path),\
+                    mock.patch('gw_cli.run_subprocess') as run:
+                self.assertTrue(bring_up_modem())
+            with open(path, 'r') as config_file:
+                self.assertEqual(config_file.read(), content)
+            self.assertEqual(run.call_args[1]['args'],
+                             ['nmcli', 'c', 'up', 'mobile'])
+
+    def test_supervisor_circuit_breaker(self):
+        now = [0]
+        supervisor = ConnectionSupervisor(
+            base_delay=1, max_delay=10, failure_threshold=2, cooldown=600,
+            metrics_path=None, bring_up=lambda: False, clock=lambda: now[0])
+        supervisor.on_state(False)
+        supervisor.attempt_reconnect()
+        self.assertFalse(supervisor.metrics['circuit_open'])
+        now[0] = 10
+        supervisor.attempt_reconnect()
+        self.assertTrue(supervisor.metrics['circuit_open'])
+        self.assertEqual(supervisor.retry_timeout(), 600)
+        now[0] = 20
+        supervisor.attempt_reconnect()
+        self.assertEqual(supervisor.metrics['reconnect_attempts'], 2)
+        supervisor.on_state(True)
+        self.assertFalse(supervisor.metrics['circuit_open'])
+
+    def test_sd_notify_without_socket(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertFalse(sd_notify('READY=1'))
+
+    def test_sd_notify_success(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            address = os.path.join(tmp_dir, 'notify')
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.bind(address)
+                with mock.patch.dict(os.environ, {'NOTIFY_SOCKET': address}):
+                    self.assertTrue(sd_notify('READY=1', 'STATUS=Connected'))
+                self.assertEqual(sock.recv(1024), b'READY=1\nSTATUS=Connected')
+
+    def test_autostart_ready_without_connection(self):
+        with mock.patch('gw_cli.autoreconnect_enabled', return_value=True),\
+                mock.patch('gw_cli.connect_at_boot', return_value=False),\
+                mock.patch('gw_cli.sd_notify') as notify:
+            self.assertFalse(autostart())
+        notify.assert_called_with('READY=1', 'STATUS=Not connected, retrying')
+
+    def test_watchdog_interval(self):
+        with mock.patch.dict(os.environ, {'WATCHDOG_USEC': '10000000'}):
+            self.assertEqual(watchdog_interval(), 5)
+        with mock.patch.dict(os.environ, {'WATCHDOG_USEC': '10000000',
+                                          'WATCHDOG_PID': '1'}):
+            self.assertIsNone(watchdog_interval())
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertIsNone(watchdog_interval())
+
+    def test_profile_switch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiles_dir = os.path.join(tmp_dir, 'profiles')
+            base = os.path.join(tmp_dir, '10-eth0.network')
+            original = '[Network]\nDHCP=true\nDHCPServer=false\n'
+            with open(base, 'w') as base_file:
+                base_file.write(original)
+            with mock.patch('gw_cli.dir_path_systemd_units', tmp_dir),\
+                    mock.patch('gw_cli.run_subprocess'):
+                render_profile('server', {
+                    'Network': {'DHCP': 'false', 'DHCPServer': 'true'},
+                    'DHCPServer': {'PoolOffset': '100'}
+                }, target=base, profiles_dir=profiles_dir)
+                self.assertEqual(list_profiles(profiles_dir), ['server'])
+                self.assertTrue(switch_profile(
+                    'server', reload=False, target=base,
+                    profiles_dir=profiles_dir))
+                # Rendering after the first link starts from the original
+                render_profile('client', {}, target=base,
+                               profiles_dir=profiles_dir)
+                self.assertEqual(list_profiles(profiles_dir),
+                                 ['client', 'server'])
+                self.assertEqual(get_active_profile(profiles_dir), 'server')
+                with open(base, 'r') as config_file:
+                    content = config_file.read()
+                self.assertIn('DHCPServer=true', content)
+                self.assertIn('PoolOffset=100', content)
+                self.assertFalse(switch_profile(
+                    'server', reload=False, target=base,
+                    profiles_dir=profiles_dir))
+                results = benchmark_profile_switch(
+                    ['client', 'server'], reload=False, target=base,
+                    profiles_dir=profiles_dir)
+            self.assertEqual([result[:2] for result in results],
+                             [('server', 'client'), ('client', 'server')])
+            with open(base, 'r') as config_file:
+                self.assertIn('DHCPServer=true', config_file.read())
+            with open(os.path.join(profiles_dir, 'client',
+                                   '10-eth0.network')) as config_file:
+                self.assertNotIn('DHCPServer=true', config_file.read())
+            with open(os.path.join(profiles_dir, '10-eth0.network.orig'),
+                      'r') as config_file:
+                self.assertEqual(config_file.read(), original)
+            self.assertTrue(os.path.isfile(os.path.join(
+                tmp_dir, 'NetworkManager.service.d', 'gw-cli-profiles.conf')))
+
+    def test_deactivate_profile_restores_original(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiles_dir = os.path.join(tmp_dir, 'profiles')
+            base = os.path.join(tmp_dir, '10-eth0.network')
+            original = '[Network]\n[DHCPServer]\nPoolOffset=1\n'
+            with open(base, 'w') as base_file:
+                base_file.write(original)
+            with mock.patch('gw_cli.dir_path_systemd_units', tmp_dir),\
+                    mock.patch('gw_cli.file_path_systemd_config', base),\
+                    mock.patch('gw_cli.dir_path_profiles', profiles_dir),\
+                    mock.patch('gw_cli.run_subprocess'):
+                render_profile('a', {'DHCPServer': {'PoolOffset': '5'}},
+                               target=base, profiles_dir=profiles_dir)
+                switch_profile('a', reload=False, target=base,
+                               profiles_dir=profiles_dir)
+                result = self.runner.invoke(deactivate_profile, args=[
+                    '--no-reload'])
+                self.assertEqual(result.exit_code, 0)
+                self.assertFalse(os.path.islink(base))
+                self.assertIsNone(get_active_profile(profiles_dir))
+                with open(base, 'r') as config_file:
+                    self.assertEqual(config_file.read(), original)
+                result = self.runner.invoke(set_dhcp_server, args=[
+                    '--domain-name', 'local',
+                    '--begin-ip-range', '100',
+                    '--end-ip-range', '50',
+                    '--lease-time', '3600'
+                ])
+                self.assertEqual(result.exit_code, 0)
+            with open(base, 'r') as config_file:
+                self.assertIn('PoolOffset=100', config_file.read())
+            with open(os.path.join(profiles_dir, 'a', '10-eth0.network'),
+                      'r') as config_file:
+                self.assertIn('PoolOffset=5', config_file.read())
+
+    def test_profile_link_refuses_direct_writes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiles_dir = os.path.join(tmp_dir, 'profiles')
+            base = os.path.join(tmp_dir, '10-eth0.network')
+            with open(base, 'w') as base_file:
+                base_file.write('[Network]\n[DHCPServer]\nPoolOffset=1\n')
+            with mock.patch('gw_cli.dir_path_systemd_units', tmp_dir),\
+                    mock.patch('gw_cli.file_path_systemd_config', base),\
+                    mock.patch('gw_cli.dir_path_profiles', profiles_dir),\
+                    mock.patch('gw_cli.run_subprocess'):
+                render_profile('a', {}, target=base,
+                               profiles_dir=profiles_dir)
+                switch_profile('a', reload=False, target=base,
+                               profiles_dir=profiles_dir)
+                result = self.runner.invoke(set_dhcp_server, args=[
+                    '--domain-name', 'local',
+                    '--begin-ip-range', '100',
+                    '--end-ip-range', '50',
+                    '--lease-time', '3600'
+                ])
+            self.assertIsInstance(result.exception, InvalidArgumentException)
+            with open(os.path.join(profiles_dir, 'a', '10-eth0.network'),
+                      'r') as config_file:
+                self.assertIn('PoolOffset=1', config_file.read())
+
+    def test_profile_switch_failure_unknown_profile(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertRaises(InvalidArgumentException, switch_profile,
+                              'missing', reload=False, profiles_dir=tmp_dir)
+            self.assertRaises(InvalidArgumentException, switch_profile,
+                              'active', reload=False, profiles_dir=tmp_dir)
+
+    def test_apply_merges_writes_and_reloads(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            network = os.path.join(tmp_dir, '10-eth0.network')
+            with open(network, 'w') as network_file:
+                network_file.write('[Network]\nAddress=10.0.0.1/24\n'
+                                   '[DHCPServer]\nPoolOffset=1\n')
+            unmanaged = os.path.join(tmp_dir, 'unmanaged.conf')
+            with open(unmanaged, 'w') as unmanaged_file:
+                unmanaged_file.write('[keyfile]\n')
+            operations = '\n'.join([
+                '{"op": "set_ipv4", "address": "10.0.0.2", "netmask": "24"}',
+                '{"op": "set_dhcp_server", "domain-name": "local", '
+                '"begin-ip-range": "100", "end-ip-range": "50", '
+                '"lease-time": 3600}',
+                '{"op": "set_ipv4", "address": "10.0.0.3", "netmask": "24"}',
+                '{"op": "set_hostname", "hostname": ""}'
+            ])
+            with mock.patch('gw_cli.file_path_systemd_config', network),\
+                    mock.patch('gw_cli.file_path_unmanaged', unmanaged),\
+                    mock.patch('gw_cli.run_subprocess') as run:
+                result = self.runner.invoke(apply, input=operations)
+            self.assertEqual(result.exit_code, 1)
+            lines = result.output.splitlines()
+            self.assertEqual(
+                [json.loads(line)['ok'] for line in lines],
+                [True, True, True, False, True])
+            commands = [call[1]['args'] for call in run.call_args_list]
+            self.assertEqual(
+                commands.count(['systemctl', 'restart', 'NetworkManager']), 2)
+            self.assertEqual(
+                [args for args in commands if args[0] == 'nmcli'],
+                [['nmcli', 'con', 'mod', 'eth0', 'ipv4.address',
+                  '10.0.0.3/24']])
+            with open(network, 'r') as network_file:
+                content = network_file.read()
+            self.assertIn('Address=10.0.0.3/24', content)
+            self.assertIn('PoolOffset=100', content)
+
+    def test_apply_flushes_before_profile_commands(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiles_dir = os.path.join(tmp_dir, 'profiles')
+            network = os.path.join(tmp_dir, '10-eth0.network')
+            with open(network, 'w') as network_file:
+                network_file.write('[Network]\nDHCPServer=false\n'
+                                   '[DHCPServer]\nPoolOffset=1\n')
+            operations = '\n'.join([
+                '{"op": "set_dhcp_server", "domain-name": "local", '
+                '"begin-ip-range": "100", "end-ip-range": "50", '
+                '"lease-time": 3600}',
+                '{"op": "create_profile", "name": "b", "dhcp-server": true}',
+                '{"op": "activate_profile", "name": "b"}',
+                '{"op": "set_dhcp_server", "domain-name": "local", '
+                '"begin-ip-range": "200", "end-ip-range": "50", '
+                '"lease-time": 3600}'
+            ])
+            with mock.patch('gw_cli.file_path_systemd_config', network),\
+                    mock.patch('gw_cli.dir_path_profiles', profiles_dir),\
+                    mock.patch('gw_cli.dir_path_systemd_units', tmp_dir),\
+                    mock.patch('gw_cli.run_subprocess'):
+                result = self.runner.invoke(apply, input=operations)
+            self.assertEqual(
+                [json.loads(line)['ok'] for line in
+                 result.stdout.splitlines()],
+                [True, True, True, False, True])
+            with open(network, 'r') as config_file:
+                content = config_file.read()
+            self.assertIn('PoolOffset=100', content)
+            self.assertIn('DHCPServer=true', content)
+
+    def test_apply_reports_failed_subprocess(self):
+        failure = subprocess.CalledProcessError(1, ['hostnamectl'])
+        with mock.patch('gw_cli.run_subprocess', return_value=failure):
+            result = self.runner.invoke(
+                apply, input='{"op": "set_hostname", "hostname": "gw"}\n')
+        self.assertEqual(result.exit_code, 1)
+        lines = [json.loads(line) for line in result.output.splitlines()]
+        self.assertFalse(lines[0]['ok'])
+        self.assertIn('hostnamectl', lines[0]['error'])
+        self.assertTrue(lines[1]['ok'])
+
+    def test_apply_restarts_before_immediate_commands(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            network = os.path.join(tmp_dir, '10-eth0.network')
+            with open(network, 'w') as network_file:
+                network_file.write('[Network]\nAddress=10.0.0.1/24\n')
+            unmanaged = os.path.join(tmp_dir, 'unmanaged.conf')
+            with open(unmanaged, 'w') as unmanaged_file:
+                unmanaged_file.write('[keyfile]\n')
+            operations = '\n'.join([
+                '{"op": "set_ipv4", "address": "10.0.0.2", "netmask": "24"}',
+                '{"op": "set_mtu", "mtu": "1400"}',
+                '{"op": "set_ipv4", "address": "10.0.0.3", "netmask": "24"}',
+                '{"op": "setup_modem"}'
+            ])
+            with mock.patch('gw_cli.file_path_systemd_config', network),\
+                    mock.patch('gw_cli.file_path_unmanaged', unmanaged),\
+                    mock.patch('gw_cli.config_handler'),\
+                    mock.patch('gw_cli.run_subprocess') as run:
+                result = self.runner.invoke(apply, input=operations)
+            self.assertEqual(result.exit_code, 0)
+            commands = [call[1]['args'] for call in run.call_args_list]
+            commands = [args for args in commands
+                        if args[0] in ('ip', 'systemctl')
+                        or args[:3] == ['nmcli', 'c', 'up']]
+            restart = ['systemctl', 'restart', 'NetworkManager']
+            self.assertEqual(commands, [
+                restart, restart,
+                ['ip', 'link', 'set', 'eth0', 'mtu', '1400'],
+                restart, restart,
+                ['nmcli', 'c', 'up', 'mobile']
+            ])
+
+    def test_apply_flush_lists_pending_operations(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            network = os.path.join(tmp_dir, '10-eth0.network')
+            with open(network, 'w') as network_file:
+                network_file.write('[Network]\n[DHCPServer]\n')
+            unmanaged = os.path.join(tmp_dir, 'unmanaged.conf')
+            with open(unmanaged, 'w') as unmanaged_file:
+                unmanaged_file.write('[keyfile]\n')
+            operations = '\n'.join([
+                '{"op": "set_ipv4", "address": "10.0.0.2", "netmask": "24"}',
+                '{"op": "set_hostname", "hostname": "gw"}',
+                '{"op": "set_dhcp_server", "domain-name": "local", '
+                '"begin-ip-range": "100", "end-ip-range": "50", '
+                '"lease-time": 3600}'
+            ])
+
+            def run(args):
+                if args[0] == 'systemctl':
+                    return subprocess.CalledProcessError(1, args)
+                return mock.Mock()
+
+            with mock.patch('gw_cli.file_path_systemd_config', network),\
+                    mock.patch('gw_cli.file_path_unmanaged', unmanaged),\
+                    mock.patch('gw_cli.run_subprocess', side_effect=run):
+                result = self.runner.invoke(apply, input=operations)
+            self.assertEqual(result.exit_code, 1)
+            lines = [json.loads(line) for line in result.stdout.splitlines()]
+            self.assertEqual([line.get('pending') for line in lines[:3]],
+                             [True, None, True])
+            self.assertEqual(lines[3]['operations'], [0, 2])
+            self.assertFalse(lines[3]['ok'])
+
+    def test_apply_failure_unknown_operation(self):
+        result = self.runner.invoke(apply, input='{"op": "supervise"}\n')
+        self.assertEqual(result.exit_code, 1)
+        self.assertFalse(json.loads(result.output.splitlines()[0])['ok'])
+
 
 if __name__ == '__main__':
     unittest.main()